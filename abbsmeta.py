@@ -2,15 +2,18 @@
 # -*- coding: utf-8 -*-
 
 import os
-import io
 import re
+import mmap
 import time
 import stat
 import sqlite3
 import logging
 import argparse
+import functools
 import posixpath
+import contextlib
 import collections
+import concurrent.futures
 
 import bashvar
 try:
@@ -25,31 +28,53 @@ logger = logging.getLogger('abbsmeta')
 re_variable = re.compile(b'^\\s*([a-zA-Z_][a-zA-Z0-9_]*)=')
 re_packagerel = re.compile(
     r'^([a-z0-9][a-z0-9+.-]*)([<>=]=|<<|>>)?([0-9A-Za-z.+~:-]*)$')
+# whitespace-bounded variant to scan a whole relvar value in one pass
+re_packagerel_scan = re.compile(
+    r'(?<!\S)([a-z0-9][a-z0-9+.-]*)([<>=]=|<<|>>)?([0-9A-Za-z.+~:-]*)(?!\S)')
 re_commitmsg = re.compile(r'^\[?([a-z0-9][a-z0-9+. ,{}*/-]*)\]?\:? (.+)$', re.M)
 re_commitrevert = re.compile(r'^(?:Revert ")+(.+?)"+$', re.M)
-abbs_categories = frozenset(('core-', 'base-', 'extra-'))
+abbs_categories = ('core-', 'base-', 'extra-')
 repo_ignore = frozenset((
     '.git', '.github', '.githubwiki', '.abbs-repo', 'repo-spec',
     'groups', 'newpak', 'assets'
 ))
+repo_ignore_prefixes = tuple(x + '/' for x in repo_ignore)
 relvars = ('PKGDEP', 'PKGRECOM', 'PKGBREAK', 'PKGCONFL', 'PKGREP',
            'PKGPROV', 'PKGSUG', 'BUILDDEP', 'PKGDEP_DPKG', 'PKGDEP_RPM')
+relvars_set = frozenset(relvars)
 re_relvars = re.compile(r'^(%s)(__\w+)?$' % '|'.join(relvars), re.ASCII)
 
 Version = collections.namedtuple('Version', ('version', 'release', 'epoch'))
+
+def default_version():
+    # module-level so defaultdicts using it stay picklable
+    return Version(None, None, None)
+
 FileChange = collections.namedtuple('FileChange', 'status name rid islink')
 
-def uniq(seq):  # Dave Kirby
-    # Order preserving
-    seen = set()
-    return [x for x in seq if x not in seen and not seen.add(x)]
+def read_file_bytes(filename):
+    # binary read through mmap: one copy, no incremental utf-8 decoder
+    with open(filename, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm.read()
+        except ValueError:
+            # empty files can't be mapped
+            return f.read()
 
 class Package:
+    __slots__ = (
+        'name', 'tree', 'secpath', 'category', 'section', 'directory',
+        'pkg_section', 'version', 'release', 'epoch', 'vermask_arch',
+        'description', 'spec', 'dependencies',
+        'fn_spec', 'fn_defines', 'err_spec', 'err_defines'
+    )
+
     def __init__(self, tree, secpath, directory, name=None):
         self.name = name
         self.tree = tree
         self.secpath = secpath
-        if any(secpath.startswith(x) for x in abbs_categories):
+        if secpath.startswith(abbs_categories):
             self.category, self.section = secpath.split('-', 1)
         else:
             self.category, self.section = None, secpath
@@ -58,10 +83,9 @@ class Package:
         self.version = None
         self.release = None
         self.epoch = None
-        self.vermask_arch = collections.defaultdict(
-            lambda: Version(None, None, None))
+        self.vermask_arch = collections.defaultdict(default_version)
         self.description = None
-        self.spec = collections.OrderedDict()
+        self.spec = {}
         self.dependencies = []
         self.fn_spec = None
         self.fn_defines = None
@@ -81,79 +105,101 @@ class Package:
     def load_spec(self, fp, filename=None, fileid=None):
         self.fn_spec = filename
         result, self.err_spec = bashvar.read_bashvar(fp, fileid, True)
-        self.spec.update(result)
-        for key in tuple(self.spec.keys()):
+        # classify while merging; no keys copy, no pop-after-update
+        spec, vermask = self.spec, self.vermask_arch
+        for key, value in result.items():
             if key == 'VER':
-                self.version = self.spec.pop(key)
+                self.version = value
             elif key == 'REL':
-                self.release = self.spec.pop(key)
+                self.release = value
             elif key.startswith('VER__'):
                 arch = key[5:].lower()
-                self.vermask_arch[arch] = self.vermask_arch[arch]._replace(
-                    version=self.spec.pop(key))
+                vermask[arch] = vermask[arch]._replace(version=value)
             elif key.startswith('REL__'):
                 arch = key[5:].lower()
-                self.vermask_arch[arch] = self.vermask_arch[arch]._replace(
-                    release=self.spec.pop(key))
+                vermask[arch] = vermask[arch]._replace(release=value)
+            else:
+                spec[key] = value
 
     def load_defines(self, fp, filename=None, fileid=None):
         self.fn_defines = filename
         result, self.err_defines = bashvar.read_bashvar(fp, fileid, True)
-        self.spec.update(result)
-        name = self.spec.pop('PKGNAME', None)
+        name = result.pop('PKGNAME', None)
         if not name:
-            # we assume it is a define for some specific architecture
+            # we assume it is a define for some specific architecture;
+            # don't pollute self.spec with its variables
             return
         self.name = name
-        for key in tuple(self.spec.keys()):
+        self.spec.update(result)
+        dependencies = []
+        relerrs = [self.err_defines] if self.err_defines else []
+        consumed = []
+        # one pass over the merged spec: metadata keys, epoch masks and
+        # relvars are disjoint, so classify them together; bind the hot
+        # lookups once
+        spec, vermask = self.spec, self.vermask_arch
+        relmatch = re_packagerel.match
+        for key, value in spec.items():
             if key == 'PKGSEC':
-                self.pkg_section = self.spec.pop(key)
+                self.pkg_section = value
             elif key == 'PKGDES':
-                self.description = self.spec.pop(key)
+                self.description = value
             elif key == 'PKGEPOCH':
-                self.epoch = self.spec.pop(key)
+                self.epoch = value
             elif key.startswith('PKGEPOCH__'):
                 arch = key[10:].lower()
-                self.vermask_arch[arch] = self.vermask_arch[arch]._replace(
-                    epoch=self.spec.pop(key))
-        dependencies = []
-        relerrs = [self.err_defines] if self.err_defines else []
-        for k, relvalue in tuple(self.spec.items()):
-            if not re_relvars.match(k):
+                vermask[arch] = vermask[arch]._replace(epoch=value)
+            elif (key.partition('__')[0] in relvars_set and
+                    re_relvars.match(key)):
+                relsp = key.rsplit('__', 1)
+                rel = relsp[0]
+                arch = '' if len(relsp) == 1 else relsp[1].lower()
+                tokens = value.split()
+                matches = re_packagerel_scan.findall(value)
+                if len(matches) == len(tokens):
+                    # common case: every token is well-formed, one
+                    # regex pass covered the whole value
+                    for deppkg, relop, depver in matches:
+                        dependencies.append((name, deppkg, relop or None,
+                                             depver or None, arch, rel))
+                else:
+                    # rescan per token so invalid ones keep their warnings
+                    for pkgname in tokens:
+                        match = relmatch(pkgname)
+                        if not match:
+                            logger.warning('invalid dependency definition in %s/%s: "%s"' % (
+                                name, rel, pkgname))
+                            relerrs.append('%s: invalid dependency definition in "%s"' % (
+                                rel, pkgname))
+                            continue
+                        deppkg, relop, depver = match.groups()
+                        dependencies.append((name, deppkg, relop, depver or None, arch, rel))
+            else:
                 continue
-            relsp = k.rsplit('__', 1)
-            rel = relsp[0]
-            arch = '' if len(relsp) == 1 else relsp[1].lower()
-            for pkgname in relvalue.split():
-                match = re_packagerel.match(pkgname)
-                if not match:
-                    logger.warning('invalid dependency definition in %s/%s: "%s"' % (
-                        name, rel, pkgname))
-                    relerrs.append('%s: invalid dependency definition in "%s"' % (
-                        rel, pkgname))
-                    continue
-                deppkg, relop, depver = match.groups()
-                dependencies.append((name, deppkg, relop, depver or None, arch, rel))
-            del self.spec[k]
-        self.dependencies = uniq(dependencies)
+            consumed.append(key)
+        for key in consumed:
+            del spec[key]
+        # order-preserving dedup; dicts keep insertion order on 3.7+
+        self.dependencies = list(dict.fromkeys(dependencies))
         if relerrs:
             self.err_defines = '\n'.join(relerrs)
 
 class PackageGroup(Package):
+    __slots__ = ()
+
     def __init__(self, tree, secpath, directory, name=None):
         self.name = name or directory
         self.tree = tree
         self.secpath = secpath
-        if any(secpath.startswith(x) for x in abbs_categories):
+        if secpath.startswith(abbs_categories):
             self.category, self.section = secpath.split('-', 1)
         else:
             self.category, self.section = None, secpath
         self.version = None
         self.release = None
-        self.vermask_arch = collections.defaultdict(
-            lambda: Version(None, None, None))
+        self.vermask_arch = collections.defaultdict(default_version)
         self.directory = directory
-        self.spec = collections.OrderedDict()
+        self.spec = {}
         self.fn_spec = None
         self.err_spec = None
 
@@ -178,21 +224,66 @@ class PackageGroup(Package):
         cls.load_defines(defines_fp, defines_filename, defines_fileid)
         return cls
 
-def parse_commit_msg(name, text):
+def init_db_pragmas(cur):
+    # the metadata is reproducible from the source repos, so trade
+    # durability for fewer fsyncs and keep the hot b-tree pages in memory
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('PRAGMA synchronous=NORMAL')
+    cur.execute('PRAGMA temp_store=MEMORY')
+    cur.execute('PRAGMA cache_size=-65536')
+    cur.execute('PRAGMA mmap_size=268435456')
+    cur.execute('PRAGMA wal_autocheckpoint=1000')
+
+def prepare_commit_msg(text):
+    # run the regexes once per commit; parse_commit_msg is called once
+    # per package with the same message
     if text is None:
         return
     if text.startswith('Merge branch '):
         return
-    match = re_commitrevert.match(text)
-    if match:
-        text = match.group(1)
-    match = re_commitmsg.match(text)
-    if match:
-        if name in match.group(1):
-            return match.group(2)
+    if text.startswith('Revert "'):
+        match = re_commitrevert.match(text)
+        if match:
+            text = match.group(1)
+    return text, re_commitmsg.match(text)
+
+def parse_commit_msg(name, prepared):
+    if prepared is None:
+        return
+    text, match = prepared
+    if match and name in match.group(1):
+        return match.group(2)
     return text
 
 
+def read_local_package_info(path, pkggroup):
+    # module-level so pool workers can run it without pickling the repo
+    results = []
+    repopath = os.path.join(pkggroup.secpath, pkggroup.directory)
+    logger.debug('read %r', pkggroup)
+    specfn = os.path.join(repopath, 'spec')
+    pkggroup.load_spec(
+        read_file_bytes(os.path.join(path, specfn)), specfn)
+    # bounded scandir recursion: only 'defines' entries matter, so skip
+    # os.walk's per-directory dirs/files list building
+    stack = [os.path.join(path, repopath)]
+    while stack:
+        subdirs = []
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name == 'defines':
+                    pkg = pkggroup.package(
+                        read_file_bytes(entry.path),
+                        os.path.relpath(entry.path, path))
+                    results.append(pkg)
+        # recurse in readdir order like os.walk did: update_package is
+        # last-write-wins, so a nameless arch-specific defines must not
+        # overtake the real one just because the stack reversed siblings
+        stack.extend(reversed(subdirs))
+    return results
+
 class LocalRepo:
     def __init__(self, path, dbfile, name=None, branch='_local',
                  category='base', priority=0):
@@ -202,12 +293,21 @@ class LocalRepo:
         self.name = name or os.path.basename(os.path.abspath(path.rstrip('/')))
         if '/' in self.name:
             raise ValueError("'/' not allowed in name. Use basepath to change directory")
-        self.db = sqlite3.connect(dbfile)
+        # enough headroom in the statement cache for every hot statement
+        self.db = sqlite3.connect(dbfile, cached_statements=256)
         self.branch = branch
         self.mainbranch = branch
         self.category = category
         self.priority = priority
         self.db.row_factory = sqlite3.Row
+        # name -> (tree, category, section, directory) snapshot of the
+        # packages table, avoiding a SELECT per package in update_package
+        self._pkg_snapshot = None
+        # name -> description mirror of fts_packages, same idea
+        self._fts_snapshot = None
+        # name -> hash of the last written spec/dependency rows, so
+        # commits that only bump VER/REL skip the delete+reinsert churn
+        self._spec_hash = {}
 
     def __repr__(self):
         return "<LocalRepo %s, path=%s>" % (self.name, self.path)
@@ -227,7 +327,7 @@ class LocalRepo:
 
     def init_db_schema(self):
         cur = self.db.cursor()
-        cur.execute('PRAGMA journal_mode=WAL')
+        init_db_pragmas(cur)
         cur.execute('CREATE TABLE IF NOT EXISTS trees ('
                     'tid INTEGER PRIMARY KEY,' # also priority
                     'name TEXT UNIQUE,'
@@ -278,7 +378,7 @@ class LocalRepo:
                     'value TEXT,'
                     'PRIMARY KEY (package, key),'
                     'FOREIGN KEY(package) REFERENCES packages(name)'
-                    ')')
+                    ') WITHOUT ROWID')
         cur.execute('CREATE TABLE IF NOT EXISTS package_dependencies ('
                     'package TEXT,'
                     'dependency TEXT,'
@@ -292,7 +392,7 @@ class LocalRepo:
                     'FOREIGN KEY(package) REFERENCES packages(name)'
                     # we may have unmatched dependency package name
                     # 'FOREIGN KEY(dependency) REFERENCES packages(name)'
-                    ')')
+                    ') WITHOUT ROWID')
         #cur.execute("DROP VIEW IF EXISTS v_packages")
         cur.execute("CREATE VIEW IF NOT EXISTS v_packages AS "
                     "SELECT p.name name, p.tree tree, "
@@ -312,6 +412,10 @@ class LocalRepo:
                     ' ON packages (directory)')
         cur.execute('CREATE INDEX IF NOT EXISTS idx_package_dependencies_rev'
                     ' ON package_dependencies (dependency)')
+        # covers the location-keyed DELETEs in scan_abbs_tree; the
+        # UNIQUE constraint only helps lookups prefixed by package
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_package_duplicate_loc'
+                    ' ON package_duplicate (tree, category, section, directory)')
         cur.execute('CREATE VIRTUAL TABLE IF NOT EXISTS fts_packages'
                     ' USING fts5(name, description, tokenize = porter)')
         self.db.commit()
@@ -325,11 +429,52 @@ class LocalRepo:
                     self.name + '/' + self.branch, self.name, self.branch, 0))
         self.db.commit()
 
+    @contextlib.contextmanager
+    def _bulk_load(self):
+        # standard SQLite bulk-load pattern: drop the reverse-dependency
+        # index for the duration of a mass update and rebuild it with one
+        # sort at the end instead of maintaining the B-tree per row
+        cur = self.db.cursor()
+        cur.execute('DROP INDEX IF EXISTS idx_package_dependencies_rev')
+        try:
+            yield
+        finally:
+            cur.execute('CREATE INDEX IF NOT EXISTS'
+                        ' idx_package_dependencies_rev'
+                        ' ON package_dependencies (dependency)')
+
+    @contextlib.contextmanager
+    def _txn(self):
+        # group the per-commit statements into one transaction so a whole
+        # batch of package mutations costs a single WAL sync
+        try:
+            yield
+        except:
+            self.db.rollback()
+            raise
+        else:
+            self.db.commit()
+
+    def load_pkg_snapshot(self):
+        cur = self.db.cursor()
+        # plain tuples; sqlite3.Row buys nothing on positional reads
+        cur.row_factory = None
+        self._pkg_snapshot = {
+            row[0]: row[1:] for row in cur.execute(
+                'SELECT name, tree, category, section, directory '
+                'FROM packages')}
+        self._fts_snapshot = dict(cur.execute(
+            'SELECT name, description FROM fts_packages'))
+
     def update_package(self, branches, pkg):
         cur = self.db.cursor()
-        existing = cur.execute(
-            'SELECT tree, category, section, directory '
-            'FROM packages WHERE name=?', (pkg.name,)).fetchone()
+        cur.row_factory = None
+        if self._pkg_snapshot is None:
+            existing = cur.execute(
+                'SELECT tree, category, section, directory '
+                'FROM packages WHERE name=?', (pkg.name,)).fetchone()
+        else:
+            existing = self._pkg_snapshot.get(pkg.name)
         if not existing:
             pass
         elif existing[0] != self.name:
@@ -369,79 +514,119 @@ class LocalRepo:
             (pkg.name, self.name, pkg.category, pkg.section,
             pkg.pkg_section, pkg.directory, pkg.description)
         )
-        res = cur.execute(
-            'SELECT description FROM fts_packages WHERE name=?',
-            (pkg.name,)).fetchone()
-        if res is None:
+        if self._pkg_snapshot is not None:
+            self._pkg_snapshot[pkg.name] = (
+                self.name, pkg.category, pkg.section, pkg.directory)
+        if self._fts_snapshot is None:
+            res = cur.execute(
+                'SELECT description FROM fts_packages WHERE name=?',
+                (pkg.name,)).fetchone()
+            known = res is not None
+            olddesc = res[0] if res else None
+        else:
+            known = pkg.name in self._fts_snapshot
+            olddesc = self._fts_snapshot.get(pkg.name)
+        if not known:
             cur.execute(
                 'INSERT INTO fts_packages VALUES (?, ?)',
                 (pkg.name, pkg.description)
             )
-        elif res[0] != pkg.description:
+        elif olddesc != pkg.description:
             cur.execute(
                 'UPDATE fts_packages SET description=? WHERE name=?',
                 (pkg.description, pkg.name)
             )
+        if self._fts_snapshot is not None:
+            self._fts_snapshot[pkg.name] = pkg.description
+        version_rows = []
         for branch in branches:
-            cur.execute(
-                'REPLACE INTO package_versions VALUES (?,?,?,?,?,?,?,?,?)',
+            version_rows.append(
                 (pkg.name, branch, '', pkg.version, pkg.release,
                 pkg.epoch, None, None, None)
             )
             for arch, mask in pkg.vermask_arch.items():
-                cur.execute(
-                    'REPLACE INTO package_versions VALUES (?,?,?,?,?,?,?,?,?)', (
+                version_rows.append((
                     pkg.name, branch, arch,
                     mask.version or pkg.version, mask.release or pkg.release,
                     mask.epoch or pkg.epoch, None, None, None
                 ))
-            if branch == self.mainbranch:
-                cur.execute('DELETE FROM package_spec WHERE package = ?', (pkg.name,))
-                for k, v in pkg.spec.items():
-                    cur.execute('REPLACE INTO package_spec VALUES (?,?,?)',
-                                (pkg.name, k, v))
-                cur.execute('DELETE FROM package_dependencies WHERE package = ?',
-                            (pkg.name,))
+        cur.executemany(
+            'REPLACE INTO package_versions VALUES (?,?,?,?,?,?,?,?,?)',
+            version_rows)
+        if self.mainbranch in branches:
+            spechash = hash((
+                tuple(pkg.spec.items()), tuple(pkg.dependencies)))
+            if self._spec_hash.get(pkg.name) != spechash:
+                self._spec_hash[pkg.name] = spechash
+                # diff against the stored rows and only touch the ones
+                # that actually changed
+                oldspec = dict(cur.execute(
+                    'SELECT key, value FROM package_spec WHERE package=?',
+                    (pkg.name,)))
+                cur.executemany(
+                    'DELETE FROM package_spec WHERE package=? AND key=?',
+                    [(pkg.name, k) for k in oldspec.keys() - pkg.spec.keys()])
+                # upsert updates changed rows in place instead of the
+                # DELETE+INSERT pair REPLACE INTO expands to
                 cur.executemany(
-                    'REPLACE INTO package_dependencies VALUES (?,?,?,?,?,?)',
-                    pkg.dependencies)
+                    'INSERT INTO package_spec VALUES (?,?,?) '
+                    'ON CONFLICT(package, key) '
+                    'DO UPDATE SET value=excluded.value',
+                    [(pkg.name, k, v) for k, v in pkg.spec.items()
+                     if k not in oldspec or oldspec[k] != v])
+                olddep = {
+                    (dep, arch, rel): (relop, version)
+                    for dep, relop, version, arch, rel in cur.execute(
+                        'SELECT dependency, relop, version, architecture, '
+                        'relationship FROM package_dependencies '
+                        'WHERE package=?', (pkg.name,))}
+                newdep = {(row[1], row[4], row[5]): row
+                          for row in pkg.dependencies}
+                cur.executemany(
+                    'DELETE FROM package_dependencies WHERE package=? '
+                    'AND dependency=? AND architecture=? AND relationship=?',
+                    [(pkg.name,) + k for k in olddep.keys() - newdep.keys()])
+                cur.executemany(
+                    'INSERT INTO package_dependencies VALUES (?,?,?,?,?,?) '
+                    'ON CONFLICT(package, dependency, architecture, '
+                    ' relationship) DO UPDATE SET relop=excluded.relop, '
+                    'version=excluded.version', [
+                        row for key, row in newdep.items()
+                        if olddep.get(key) != (row[2], row[3])])
         logger.debug('add: ' + pkg.name)
 
     def read_package_info(self, pkggroup):
-        results = []
-        repopath = os.path.join(pkggroup.secpath, pkggroup.directory)
-        logger.debug('read %r', pkggroup)
-        specfn = os.path.join(repopath, 'spec')
-        with open(os.path.join(self.path, specfn), 'r', encoding='utf-8') as f:
-            pkggroup.load_spec(f, specfn)
-        for root, dirs, files in os.walk(os.path.join(self.path, repopath)):
-            for filename in files:
-                if filename != 'defines':
-                    continue
-                definesfn = os.path.join(root, 'defines')
-                definesfn_rel = os.path.relpath(definesfn, self.path)
-                with open(definesfn, 'r', encoding='utf-8') as f:
-                    pkg = pkggroup.package(f, definesfn_rel)
-                results.append(pkg)
-        return results
+        return read_local_package_info(self.path, pkggroup)
 
-    def scan_abbs_tree(self):
+    def scan_dir_mtime(self):
+        """Latest file mtime under each secpath/directory, from one
+        scandir pass; DirEntry caches the lstat result."""
+        def latest_mtime(path):
+            latest = -1
+            for entry in os.scandir(path):
+                fstat = entry.stat(follow_symlinks=False)
+                if entry.is_dir(follow_symlinks=False):
+                    latest = max(latest, latest_mtime(entry.path))
+                elif stat.S_ISREG(fstat.st_mode):
+                    latest = max(latest, int(fstat.st_mtime))
+            return latest
         dir_mtime = {}
-        for root, dirs, files in os.walk(self.path):
-            pathspl = os.path.relpath(root, self.path).split(os.sep)
-            if not len(pathspl) >= 2:
-                continue
-            if pathspl[0] in repo_ignore:
+        for secdir in os.scandir(self.path):
+            if (secdir.name in repo_ignore
+                or not secdir.is_dir(follow_symlinks=False)):
                 continue
-            pkgpath = '/'.join(pathspl[:2])
-            for filename in files:
-                fullname = os.path.join(root, filename)
-                fstat = os.lstat(fullname)
-                if not stat.S_ISREG(fstat.st_mode):
+            for pkgdir in os.scandir(secdir.path):
+                if not pkgdir.is_dir(follow_symlinks=False):
                     continue
-                dir_mtime[pkgpath] = max(
-                    dir_mtime.get(pkgpath, 0), int(fstat.st_mtime))
+                mtime = latest_mtime(pkgdir.path)
+                if mtime >= 0:
+                    dir_mtime[secdir.name + '/' + pkgdir.name] = mtime
+        return dir_mtime
+
+    def scan_abbs_tree(self):
+        dir_mtime = self.scan_dir_mtime()
         cur = self.db.cursor()
+        cur.row_factory = None
         cur.execute("CREATE TEMP TABLE t_localdirs ("
             "fullpath TEXT PRIMARY KEY, mtime INTEGER)")
         cur.executemany("INSERT INTO t_localdirs VALUES (?,?)",
@@ -490,22 +675,32 @@ class LocalRepo:
         cur.execute(
             "DELETE FROM fts_packages WHERE name IN (SELECT name FROM t_pkgrm)")
         self.db.commit()
+        self.load_pkg_snapshot()
         cur.execute("""
             SELECT b.fullpath, b.mtime
             FROM t_localdirs b
             LEFT JOIN t_lastdirs a USING (fullpath)
             WHERE a.fullpath IS NULL OR a.mtime IS NULL OR b.mtime > a.mtime
         """)
-        for fullpath, mtime in cur.fetchall():
-            path, pkgpath = fullpath.split('/')
-            pkggroup = PackageGroup(self.name, path, pkgpath)
-            for pkg in self.read_package_info(pkggroup):
-                self.update_package((self.branch,), pkg)
-                cur.execute(
-                    'UPDATE package_versions SET commit_time=? '
-                    'WHERE package=? AND branch=?',
-                    (mtime, pkg.name, self.branch)
-                )
+        rows = cur.fetchall()
+        groups = [PackageGroup(self.name, *fullpath.split('/'))
+                  for fullpath, mtime in rows]
+        # file reads and bash parsing are independent per package group
+        # and the scanner burns CPU under the GIL, so fan them out to
+        # worker processes; only the DB writes below stay in this process
+        with self._bulk_load(), concurrent.futures.ProcessPoolExecutor(
+                max_workers=os.cpu_count()) as executor:
+            for (fullpath, mtime), pkgs in zip(
+                    rows, executor.map(
+                        functools.partial(read_local_package_info, self.path),
+                        groups, chunksize=16)):
+                for pkg in pkgs:
+                    self.update_package((self.branch,), pkg)
+                    cur.execute(
+                        'UPDATE package_versions SET commit_time=? '
+                        'WHERE package=? AND branch=?',
+                        (mtime, pkg.name, self.branch)
+                    )
         cur.execute(
             'DELETE FROM package_duplicate WHERE package IN '
             '(SELECT package FROM package_duplicate '
@@ -542,7 +737,7 @@ class SourceRepo(LocalRepo):
         self.basepath = basepath
         self.markpath = markpath
         self.dbfile = dbfile
-        self.db = sqlite3.connect(dbfile)
+        self.db = sqlite3.connect(dbfile, cached_statements=256)
         self.branches = branches
         self.mainbranch = mainbranch
         if branches and mainbranch not in branches:
@@ -560,13 +755,23 @@ class SourceRepo(LocalRepo):
         self.fossilpath = os.path.join(basepath, name + '.fossil')
         # db for syncing among Fossil, Git and Abbs-meta database
         self.marksdbfile = os.path.join(markpath, name + '-marks.db')
-        self.marksdb = sqlite3.connect(self.marksdbfile)
+        self.marksdb = sqlite3.connect(self.marksdbfile, cached_statements=256)
         self.db.row_factory = self.marksdb.row_factory = sqlite3.Row
+        self._pkg_snapshot = None
+        self._fts_snapshot = None
+        self._spec_hash = {}
+        self._fnid_name = None
         if not os.path.isfile(self.fossilpath):
             self.sync()
         self.fossil = fossil.Repo(self.fossilpath)
-        self._cache_branch = fossil.LRUCache(16)
-        self._cache_flist = fossil.LRUCache(16)
+        # branch lists and change lists are tiny; manifests are not,
+        # so keep fewer of those around
+        self.file_list = functools.lru_cache(maxsize=64)(self.file_list)
+        self.file_index = functools.lru_cache(maxsize=64)(self.file_index)
+        self._file_change_brief = functools.lru_cache(maxsize=256)(
+            self._file_change_brief)
+        self.branches_of_commit = functools.lru_cache(maxsize=256)(
+            self.branches_of_commit)
 
     def __repr__(self):
         return "<SourceRepo %s, basepath=%s>" % (self.name, self.basepath)
@@ -596,7 +801,7 @@ class SourceRepo(LocalRepo):
             cur.execute('REPLACE INTO tree_branches VALUES (?,?,?,?)', (
                         self.name + '/' + branch, self.name, branch, k))
         mcur = self.marksdb.cursor()
-        mcur.execute('PRAGMA journal_mode=WAL')
+        init_db_pragmas(mcur)
         mcur.execute('CREATE TABLE IF NOT EXISTS package_rel ('
                      'rid INTEGER, package TEXT, '
                      'version TEXT, release TEXT, epoch TEXT, '
@@ -618,92 +823,128 @@ class SourceRepo(LocalRepo):
         reposync.sync(self.gitpath, self.fossilpath, self.markpath,
                       trackbranches=self.branches)
 
-    def file_list(self, mid):
-        if mid in self._cache_flist:
-            return self._cache_flist[mid]
+    @contextlib.contextmanager
+    def _txn(self):
+        try:
+            yield
+        except:
+            self.db.rollback()
+            self.marksdb.rollback()
+            raise
         else:
-            self._cache_flist[mid] = flist = collections.OrderedDict((
-                (row[0], (row[1], row[2] if len(row) > 2 else ''))
-                for row in self.fossil.manifest(mid).F
-            ))
-            return flist
+            self.db.commit()
+            self.marksdb.commit()
+
+    def file_list(self, mid):
+        return {
+            row[0]: (row[1], row[2] if len(row) > 2 else '')
+            for row in self.fossil.manifest(mid).F
+        }
+
+    def file_index(self, mid):
+        """Return (set of directories, basename -> [paths]) of a manifest."""
+        dirs = set()
+        names = {}
+        for path in self.file_list(mid):
+            names.setdefault(path.rsplit('/', 1)[-1], []).append(path)
+            pos = path.rfind('/')
+            while pos != -1:
+                parent = path[:pos]
+                if parent in dirs:
+                    break
+                dirs.add(parent)
+                pos = path.rfind('/', 0, pos)
+        return (frozenset(dirs), names)
 
     def getfile(self, mid, path, text=False):
         uuid = self.file_list(mid)[path][0]
         blob = self.fossil.file(uuid).blob
         if text:
-            return uuid, io.StringIO(blob.decode('utf-8'))
+            return uuid, blob.decode('utf-8')
         else:
-            return uuid, io.BytesIO(blob)
+            return uuid, blob
 
     def file_change(self, mid, full=False):
-        ret = []
         if full:
-            for fn, v in self.file_list(mid).items():
-                ret.append(FileChange('+', fn,
-                    self.fossil.to_rid(v[0]), ('l' in v[1])))
-            return ret
-        for fid, pid, fn, pfn, mperm in self.fossil.execute(
-            'SELECT mlink.fid, mlink.pid, fn.name fn, pfn.name pfn, mlink.mperm '
-            'FROM mlink '
-            'LEFT JOIN filename fn ON fn.fnid=mlink.fnid '
-            'LEFT JOIN filename pfn ON pfn.fnid=mlink.pfnid '
-            'WHERE mid = ?', (mid,)):
+            return [
+                FileChange('+', fn, self.fossil.to_rid(v[0]), ('l' in v[1]))
+                for fn, v in self.file_list(mid).items()
+            ]
+        return self._file_change_brief(mid)
+
+    def filename_map(self):
+        # the filename table is append-only and the fossil repo is fully
+        # synced before the history walk, so load it once per repo
+        if self._fnid_name is None:
+            self._fnid_name = dict(self.fossil.execute(
+                'SELECT fnid, name FROM filename'))
+        return self._fnid_name
+
+    def _file_change_brief(self, mid):
+        # resolve fnid -> name from the in-memory filename table instead
+        # of two LEFT JOIN probes per mlink row
+        names = self.filename_map()
+        ret = []
+        for fid, pid, fnid, pfnid, mperm in self.fossil.execute(
+                'SELECT fid, pid, fnid, pfnid, mperm '
+                'FROM mlink WHERE mid = ?', (mid,)):
+            islink = (mperm == 2)
             if fid == 0:
                 # deleted
-                ret.append(FileChange('-', fn, pid, mperm == 2))
-            elif pfn:
-                # renamed
-                ret.append(FileChange('-', pfn, pid, mperm == 2))
-                ret.append(FileChange('+', fn, fid, mperm == 2))
+                ret.append(FileChange('-', names.get(fnid), pid, islink))
             else:
-                # added if pid == 0 else changed
-                ret.append(FileChange('+', fn, fid, mperm == 2))
+                if pfnid:
+                    # old name of a rename
+                    ret.append(FileChange(
+                        '-', names.get(pfnid), pid, islink))
+                # added, changed, or the new name of a rename
+                ret.append(FileChange('+', names.get(fnid), fid, islink))
         return ret
 
     def exists(self, mid, path, isdir=False, ignorelink=False):
-        for fn, v in self.file_list(mid).items():
-            if fn == path:
-                if ignorelink and 'l' in v[1]:
-                    return False
-                else:
-                    return True
-            elif isdir and fn.startswith(path + '/'):
-                return True
+        v = self.file_list(mid).get(path)
+        if v is not None:
+            return not (ignorelink and 'l' in v[1])
+        elif isdir:
+            return path in self.file_index(mid)[0]
         return False
 
     def branches_of_commit(self, mid):
-        if mid in self._cache_branch:
-            return self._cache_branch[mid]
         mcur = self.marksdb.cursor()
         results = frozenset(x[0] for x in mcur.execute(
             "SELECT tagname FROM branches WHERE rid=?", (mid,)).fetchall())
         if not self.branches:
-            branches = list(results)
-        else:
-            branches = [b for b in self.branches if b in results]
-        self._cache_branch[mid] = branches
-        return branches
+            return list(results)
+        return [b for b in self.branches if b in results]
 
     def list_update(self, mid, full=False):
         pkgs = set()
+        spec_exists = {}
         diff = self.file_change(mid, full)
         for change in diff:
+            # reject ignored top-level dirs before allocating the split
+            if change.name.startswith(repo_ignore_prefixes):
+                continue
             pathspl = change.name.split('/', 2)
             if not len(pathspl) > 2:
                 continue
             path, pkgpath = pathspl[:2]
             changestatus = change.status
-            if path in repo_ignore or (path, pkgpath) in pkgs:
+            key = (path, pkgpath)
+            if key in pkgs:
                 continue
-            elif (change.status == '+' and not self.exists(
-                mid, posixpath.join(path, pkgpath, 'spec'), ignorelink=True)):
+            # a commit often touches many files in one package directory;
+            # probe for its spec only once
+            specexist = spec_exists.get(key)
+            if specexist is None:
+                spec_exists[key] = specexist = self.exists(
+                    mid, posixpath.join(path, pkgpath, 'spec'), ignorelink=True)
+            if change.status == '+' and not specexist:
                 continue
-            elif (change.status == '-' and self.exists(
-                mid, posixpath.join(path, pkgpath, 'spec'), ignorelink=True)):
+            elif change.status == '-' and specexist:
                 changestatus = '+'
             yield PackageGroup(self.name, path, pkgpath), changestatus
-            pkgs.add((path, pkgpath))
+            pkgs.add(key)
 
     def read_package_info(self, mid, pkggroup):
         results = []
@@ -711,22 +952,24 @@ class SourceRepo(LocalRepo):
         logger.debug('read %r', pkggroup)
         filelist = self.file_list(mid)
         specfn = posixpath.join(repopath, 'spec')
-        uuid, specstr = self.getfile(mid, specfn, True)
-        pkggroup.load_spec(specstr, specfn, uuid[:16])
-        for path, fattr in filelist.items():
-            if path.startswith(repopath + '/'):
-                dirpath, filename = os.path.split(path)
-                if filename != 'defines':
-                    continue
-                definesfn = posixpath.join(dirpath, 'defines')
-                uuid, defines = self.getfile(mid, definesfn, True)
-                pkg = pkggroup.package(defines, definesfn, uuid[:16])
-                results.append(pkg)
+        targets = [(specfn, filelist[specfn][0])]
+        for definesfn in self.file_index(mid)[1].get('defines', ()):
+            if definesfn.startswith(repopath + '/'):
+                targets.append((definesfn, filelist[definesfn][0]))
+        # fetch the spec and all defines blobs in one round-trip
+        blobs = self.fossil.files(uuid for fn, uuid in targets)
+        uuid = targets[0][1]
+        pkggroup.load_spec(blobs[uuid].blob, specfn, uuid[:16])
+        for definesfn, uuid in targets[1:]:
+            pkg = pkggroup.package(blobs[uuid].blob, definesfn, uuid[:16])
+            results.append(pkg)
         return results
 
     def scan_abbs_tree(self, mid):
         cur = self.db.cursor()
+        cur.row_factory = None
         mcur = self.marksdb.cursor()
+        mcur.row_factory = None
         githash, exist = mcur.execute(
             "SELECT m.githash, r.rid FROM marks m "
             "LEFT JOIN package_rel r USING (rid) "
@@ -735,17 +978,18 @@ class SourceRepo(LocalRepo):
             return
         commitmsg = self.fossil.execute(
             'SELECT comment FROM event WHERE objid=?', (mid,)).fetchone()
-        if commitmsg:
-            commitmsg = commitmsg[0]
+        commitmsg = prepare_commit_msg(commitmsg[0] if commitmsg else None)
+        branches = self.branches_of_commit(mid)
         for pkggroup, change in self.list_update(mid):
             removedpkgs = []
+            category = pkggroup.category or ''
             for row in cur.execute(
                 'SELECT name FROM packages p '
                 'WHERE category IS ? AND section=? AND directory=? AND tree=?',
                 (pkggroup.category, pkggroup.section, pkggroup.directory,
                 self.name)).fetchall():
                 name = row[0]
-                for branch in self.branches_of_commit(mid):
+                for branch in branches:
                     cur.execute('DELETE FROM package_versions WHERE '
                                 'package=? AND branch=?', (name, branch))
                 if not cur.execute(
@@ -754,7 +998,7 @@ class SourceRepo(LocalRepo):
                     cur.execute('DELETE FROM package_duplicate '
                                 'WHERE package=? AND tree=? AND category=? '
                                 ' AND section=? AND directory=?',
-                                (name, self.name, pkggroup.category or '',
+                                (name, self.name, category,
                                 pkggroup.section, pkggroup.directory))
                     cur.execute('DELETE FROM package_spec WHERE package=?',
                                 (name,))
@@ -763,6 +1007,11 @@ class SourceRepo(LocalRepo):
                     cur.execute('DELETE FROM packages WHERE name=?', (name,))
                     cur.execute('DELETE FROM fts_packages WHERE name=?',
                                 (name,))
+                    if self._pkg_snapshot is not None:
+                        self._pkg_snapshot.pop(name, None)
+                    if self._fts_snapshot is not None:
+                        self._fts_snapshot.pop(name, None)
+                    self._spec_hash.pop(name, None)
                     if change == '-':
                         logger.info('removed: ' + name)
                     else:
@@ -772,12 +1021,11 @@ class SourceRepo(LocalRepo):
             cur.execute(
                 'DELETE FROM package_duplicate '
                 'WHERE category=? AND section=? AND directory=? AND tree=?',
-                (pkggroup.category or '', pkggroup.section,
-                 pkggroup.directory, self.name)
+                (category, pkggroup.section, pkggroup.directory, self.name)
             )
             if change == '+':
                 for pkg in self.read_package_info(mid, pkggroup):
-                    self.update_package(self.branches_of_commit(mid), pkg)
+                    self.update_package(branches, pkg)
                     cmsg = parse_commit_msg(pkg.name, commitmsg)
                     if not cmsg:
                         continue
@@ -788,14 +1036,14 @@ class SourceRepo(LocalRepo):
                     if pkg.err_defines:
                         mcur.execute(
                             'REPLACE INTO package_basherr VALUES (?,?,?,?,?,?,?)',
-                            (mid, pkg.fn_defines, pkggroup.category or '',
+                            (mid, pkg.fn_defines, category,
                             pkggroup.section, pkggroup.directory, pkg.name,
                             pkg.err_defines)
                         )
                 if pkggroup.err_spec:
                     mcur.execute(
                         'REPLACE INTO package_basherr VALUES (?,?,?,?,?,?,?)',
-                        (mid, pkggroup.fn_spec, pkggroup.category or '',
+                        (mid, pkggroup.fn_spec, category,
                         pkggroup.section, pkggroup.directory, None,
                         pkggroup.err_spec)
                     )
@@ -819,7 +1067,7 @@ class SourceRepo(LocalRepo):
                 continue
             pkggroup = PackageGroup(self.name, secpath, directory)
             for pkg in self.read_package_info(mid, pkggroup):
-                self.update_package(self.branches_of_commit(mid), pkg)
+                self.update_package(branches, pkg)
         cur.execute(
             'DELETE FROM package_duplicate WHERE package IN '
             '(SELECT package FROM package_duplicate '
@@ -828,7 +1076,9 @@ class SourceRepo(LocalRepo):
 
     def repo_update(self):
         cur = self.db.cursor()
+        cur.row_factory = None
         mcur = self.marksdb.cursor()
+        mcur.row_factory = None
         last_update = cur.execute(
             'SELECT pv.commit_time FROM packages p '
             'INNER JOIN package_versions pv ON pv.package=p.name '
@@ -838,16 +1088,19 @@ class SourceRepo(LocalRepo):
         last_rid = mcur.execute(
             'SELECT rid FROM package_rel ORDER BY rid DESC LIMIT 1').fetchone()
         last_rid = last_rid[0] if last_rid else 0
-        for mtime, mid, uuid in self.fossil.execute(
-            "SELECT round((mtime-2440587.5)*86400), objid, blob.uuid "
-            "FROM event "
-            "LEFT JOIN blob ON blob.rid=event.objid "
-            "WHERE (mtime>=? OR objid>?) AND type='ci' ORDER BY mtime, objid",
-            (fossil.unix_to_julian(last_update), last_rid)).fetchall():
-            if not self.branches_of_commit(mid):
-                continue
-            logger.info('%s: %d %s', time.strftime('%Y-%m-%d', time.gmtime(mtime)), mid, uuid[:16])
-            self.scan_abbs_tree(mid)
+        self.load_pkg_snapshot()
+        with self._bulk_load():
+            for mtime, mid, uuid in self.fossil.execute(
+                "SELECT round((mtime-2440587.5)*86400), objid, blob.uuid "
+                "FROM event "
+                "LEFT JOIN blob ON blob.rid=event.objid "
+                "WHERE (mtime>=? OR objid>?) AND type='ci' ORDER BY mtime, objid",
+                (fossil.unix_to_julian(last_update), last_rid)):
+                if not self.branches_of_commit(mid):
+                    continue
+                logger.info('%s: %d %s', time.strftime('%Y-%m-%d', time.gmtime(mtime)), mid, uuid[:16])
+                with self._txn():
+                    self.scan_abbs_tree(mid)
         mcur.execute('PRAGMA optimize')
         mcur.close()
         self.marksdb.commit()
@@ -876,8 +1129,8 @@ class SourceRepo(LocalRepo):
             ORDER BY commit_time, pr.package
         ''', (self.name,))
         cur.execute('DELETE FROM t_package_versions WHERE version IS NULL')
-        cur.execute('CREATE INDEX idx_t_package_versions '
-            'ON t_package_versions (package)')
+        # no index on the temp table: the REPLACE below scans t and
+        # probes package_versions through its primary key
         cur.execute('''
             REPLACE INTO package_versions
             SELECT t.* FROM t_package_versions t
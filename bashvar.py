@@ -2,93 +2,30 @@
 # -*- coding: utf-8 -*-
 
 import re
+import atexit
+import shutil
 import logging
 import tempfile
 import warnings
+import functools
 import subprocess
-import collections
-import pyparsing as pp
-
-pp.ParserElement.enablePackrat()
-
-re_variable = re.compile('^\\s*([a-zA-Z_][a-zA-Z0-9_]*)=')
-
-whitespace = pp.White(ws=' \t').suppress().setName("whitespace")
-optwhitespace = pp.Optional(whitespace).setName("optwhitespace")
-comment = ('#' + pp.Optional(pp.CharsNotIn('\n'))).setName("comment")
-integer = (pp.Word(pp.nums) | pp.Combine('-' + pp.Word(pp.nums)))
-
-varname = pp.Word(pp.alphas + '_', pp.alphanums + '_').setResultsName("varname")
-# ${parameter/pattern/string}
-substsafe = pp.CharsNotIn('/#%[}\'"`\\')
-
-expansion_param = pp.Group(
-    pp.Literal('$').setResultsName("expansion") +
-    # we don't want to parse all the expansions
-    ((
-        pp.Literal('{').suppress() +
-        varname +
-        pp.Optional(
-            (pp.Literal(':').setResultsName("exptype") + pp.Group(
-                pp.Word(pp.nums) |
-                (whitespace + pp.Combine('-' + pp.Word(pp.nums)))
-                ).setResultsName("offset") +
-                pp.Optional(pp.Literal(':') + integer.setResultsName("length")))
-            ^ (pp.oneOf('/ //').setResultsName("exptype") +
-                pp.Optional(substsafe.setResultsName("pattern") +
-                pp.Optional(pp.Literal('/') +
-                pp.Optional(substsafe, '').setResultsName("string")))
-            )
-            ^ (pp.oneOf("# ## % %%").setResultsName("exptype") +
-                pp.Optional(substsafe.setResultsName("pattern"))
-            )
-        ) +
-        pp.Literal('}').suppress()
-    ) | varname)
-)
-
-singlequote = pp.Group(
-    pp.Literal("'").setResultsName("quote") +
-    pp.Optional(pp.CharsNotIn("'"), '').setResultsName("value") +
-    pp.Literal("'").suppress()
-).setName("singlequote")
-doublequote_escape = (
-    (pp.Literal('\\').suppress() + pp.Word('$`"\\', exact=1)) |
-    pp.Literal('\\\n').suppress()
-)
-doublequote = pp.Group(
-    pp.Literal('"').setResultsName("quote") +
-    pp.Group(pp.ZeroOrMore(
-        doublequote_escape | expansion_param | pp.CharsNotIn('$`\\*"')
-    )).setResultsName("value") +
-    pp.Literal('"').suppress()
-).setName("doublequote")
-
-plain_word = pp.Combine(
-    pp.CharsNotIn('~{}()$\'"`\\*?[] \t\n', exact=1) +
-    pp.Optional(pp.CharsNotIn('{}()$\'"`\\*?[] \t\n'))
-)
-
-texttoken = (
-    singlequote | doublequote | expansion_param | plain_word
-)
-varvalue = pp.Group(pp.ZeroOrMore(texttoken)).setResultsName('varvalue')
-varassign = (
-    varname +
-    pp.Literal('=').setResultsName('operator') +
-    varvalue
-).setName('varassign').leaveWhitespace()
-
-line = pp.Group(
-    pp.lineStart + optwhitespace +
-    pp.Optional(varassign) + optwhitespace +
-    pp.Optional(comment).suppress() +
-    pp.lineEnd.suppress()
-).setName('line').leaveWhitespace()
-
-bashvarfile = pp.ZeroOrMore(line)
-
-ParseException = pp.ParseException
+
+re_variable = re.compile('^[ \\t]*([a-zA-Z_][a-zA-Z0-9_]*)=', re.M | re.A)
+
+# hand-written scanner over the literal bash-assignment subset; anything
+# beyond it (globs, braces, command substitution, fancy expansions)
+# raises ParseException and falls back to a real bash
+re_varname = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*')
+# a word may start with anything but shell metacharacters ('~' only
+# barred in first position), and continues until the next one
+re_plainword = re.compile(
+    '[^~{}()$\'"`\\\\*?\\[\\] \t\n][^{}()$\'"`\\\\*?\\[\\] \t\n]*')
+# literal run inside double quotes
+re_dquote_lit = re.compile('[^$`\\\\*"]+')
+# ${parameter/pattern/string}: pattern and string character set
+re_substsafe = re.compile('[^/#%\\[}\'"`\\\\]+')
+re_digits = re.compile('[0-9]+')
+re_integer = re.compile('-?[0-9]+')
 
 class VariableWarning(UserWarning):
     pass
@@ -99,7 +36,13 @@ class BashErrorWarning(UserWarning):
 class ParseError(Exception):
     pass
 
+class ParseException(ParseError):
+    pass
+
+@functools.lru_cache(maxsize=1024)
 def _compile_pattern(pattern, greedy=True, mode=None):
+    # boilerplate like ${VER%-*} recurs across specs; compiled patterns
+    # are immutable so they can be shared freely
     regex = re.escape(pattern)
     if mode == 'end':
         regex = regex.replace('\\?', '.').replace('\\*', '.*')
@@ -114,108 +57,236 @@ def _compile_pattern(pattern, greedy=True, mode=None):
             regex = '^' + regex
     return re.compile(regex)
 
-def combine_value(tokens, variables):
-    val = ''
-    if tokens.get('quote') == '"':
-        val += combine_value(tokens['value'], variables)
-    elif tokens.get('quote') == "'":
-        val += tokens['value']
-    elif tokens.get('expansion') == '$':
-        varname = tokens['varname']
-        if varname in variables:
-            var = variables[varname]
-            exptype = tokens.get('exptype')
-            if exptype is None:
-                pass
-            elif exptype == ':':
-                if 'offset' in tokens:
-                    offset = int(tokens['offset'][0].strip())
-                    if 'length' in tokens:
-                        length = int(tokens['length'])
-                        if length >= 0:
-                            var = var[offset:offset+length]
-                        else:
-                            var = var[offset:length]
-                    else:
-                        var = var[offset:]
-            elif exptype[0] == '/':
-                pattern = _compile_pattern(tokens.get('pattern', ''))
-                newstring = tokens.get('string', '')
-                if exptype == '/':
-                    var = pattern.sub(newstring, var, count=1)
-                elif exptype == '//':
-                    var = pattern.sub(newstring, var)
-            elif exptype[0] == '#':
-                pattern = _compile_pattern(
-                    tokens.get('pattern', ''), (exptype == '##'), 'start')
-                match = pattern.match(var)
+def _expand_var(variables, varname, exptype, args):
+    if varname not in variables:
+        warnings.warn('variable "%s" is undefined' % varname, VariableWarning)
+        return ''
+    var = variables[varname]
+    if exptype is None:
+        pass
+    elif exptype == ':':
+        offset, length = args
+        if length is None:
+            var = var[offset:]
+        elif length >= 0:
+            var = var[offset:offset+length]
+        else:
+            var = var[offset:length]
+    elif exptype[0] == '/':
+        pattern = _compile_pattern(args[0])
+        if exptype == '/':
+            var = pattern.sub(args[1], var, count=1)
+        else:
+            var = pattern.sub(args[1], var)
+    elif exptype[0] == '#':
+        pattern = _compile_pattern(args[0], (exptype == '##'), 'start')
+        match = pattern.match(var)
+        if match:
+            var = var[match.end():]
+    elif exptype[0] == '%':
+        pattern = _compile_pattern(args[0], (exptype == '%%'), 'end')
+        match = pattern.search(var)
+        if match:
+            var = var[:match.start(1)]
+    return var
+
+def _parse_expansion(source, pos, variables):
+    """Parse $NAME or ${NAME[op...]} with the scanner at the char after
+    '$'; return (expanded value, position after the expansion)."""
+    if source[pos:pos+1] != '{':
+        match = re_varname.match(source, pos)
+        if not match:
+            raise ParseException('expected variable name at %d' % pos)
+        return _expand_var(variables, match.group(), None, None), match.end()
+    match = re_varname.match(source, pos + 1)
+    if not match:
+        raise ParseException('expected variable name at %d' % (pos + 1))
+    varname = match.group()
+    pos = match.end()
+    char = source[pos:pos+1]
+    exptype = args = None
+    if char == ':':
+        exptype = ':'
+        pos += 1
+        match = re_digits.match(source, pos)
+        if not match:
+            # negative offsets need whitespace to disambiguate from :-
+            wsend = pos
+            while source[wsend:wsend+1] in (' ', '\t'):
+                wsend += 1
+            if wsend > pos and source[wsend:wsend+1] == '-':
+                match = re_digits.match(source, wsend + 1)
                 if match:
-                    var = var[match.end():]
-            elif exptype[0] == '%':
-                pattern = _compile_pattern(
-                    tokens.get('pattern', ''), (exptype == '%%'), 'end')
-                match = pattern.search(var)
+                    offset = -int(match.group())
+                    pos = match.end()
+            if not match:
+                raise ParseException('bad substring offset at %d' % pos)
+        else:
+            offset = int(match.group())
+            pos = match.end()
+        length = None
+        if source[pos:pos+1] == ':':
+            match = re_integer.match(source, pos + 1)
+            if not match:
+                raise ParseException('bad substring length at %d' % (pos + 1))
+            length = int(match.group())
+            pos = match.end()
+        args = (offset, length)
+    elif char == '/':
+        exptype = '//' if source[pos+1:pos+2] == '/' else '/'
+        pos += len(exptype)
+        pattern = string = ''
+        match = re_substsafe.match(source, pos)
+        if match:
+            pattern = match.group()
+            pos = match.end()
+            # the replacement is only allowed after a pattern
+            if source[pos:pos+1] == '/':
+                match = re_substsafe.match(source, pos + 1)
                 if match:
-                    var = var[:match.start(1)]
-            val += var
+                    string = match.group()
+                    pos = match.end()
+                else:
+                    pos += 1
+        args = (pattern, string)
+    elif char in ('#', '%'):
+        exptype = char * 2 if source[pos+1:pos+2] == char else char
+        pos += len(exptype)
+        match = re_substsafe.match(source, pos)
+        pattern = ''
+        if match:
+            pattern = match.group()
+            pos = match.end()
+        args = (pattern,)
+    if source[pos:pos+1] != '}':
+        raise ParseException('expected "}" at %d' % pos)
+    return _expand_var(variables, varname, exptype, args), pos + 1
+
+def _parse_dquote(source, pos, variables):
+    """Parse a double-quoted string with the scanner at the char after
+    the opening quote; return (value, position after closing quote)."""
+    out = []
+    while True:
+        char = source[pos:pos+1]
+        if not char:
+            raise ParseException('unterminated double quote')
+        if char == '"':
+            return ''.join(out), pos + 1
+        elif char == '\\':
+            nextc = source[pos+1:pos+2]
+            if nextc in ('$', '`', '"', '\\'):
+                out.append(nextc)
+            elif nextc != '\n':
+                raise ParseException('bad escape at %d' % pos)
+            pos += 2
+        elif char == '$':
+            val, pos = _parse_expansion(source, pos + 1, variables)
+            out.append(val)
         else:
-            warnings.warn('variable "%s" is undefined' % varname, VariableWarning)
-    else:
-        for tok in tokens:
-            if isinstance(tok, str):
-                val += tok
-            else:
-                val += combine_value(tok, variables)
-    return ''.join(val)
+            match = re_dquote_lit.match(source, pos)
+            if not match:
+                # '*' or '`'
+                raise ParseException('unexpected %r at %d' % (char, pos))
+            out.append(match.group())
+            pos = match.end()
 
 def eval_bashvar_literal(source):
-    parsed = bashvarfile.parseString(source, parseAll=True)
-    variables = collections.OrderedDict()
-    for line in parsed:
-        if not line:
+    variables = {}
+    pos, size = 0, len(source)
+    while pos < size:
+        while source[pos:pos+1] in (' ', '\t'):
+            pos += 1
+        char = source[pos:pos+1]
+        if not char:
+            break
+        elif char == '\n':
+            pos += 1
             continue
-        val = combine_value(line['varvalue'], variables)
-        # only supports line['operator'] == '='
-        variables[line['varname']] = val
+        elif char == '#':
+            end = source.find('\n', pos)
+            pos = size if end < 0 else end + 1
+            continue
+        match = re_varname.match(source, pos)
+        if not match or source[match.end():match.end()+1] != '=':
+            raise ParseException('expected assignment at %d' % pos)
+        name = match.group()
+        pos = match.end() + 1
+        out = []
+        while pos < size and source[pos] not in ' \t\n':
+            char = source[pos]
+            if char == "'":
+                end = source.find("'", pos + 1)
+                if end < 0:
+                    raise ParseException('unterminated single quote')
+                out.append(source[pos+1:end])
+                pos = end + 1
+            elif char == '"':
+                val, pos = _parse_dquote(source, pos + 1, variables)
+                out.append(val)
+            elif char == '$':
+                val, pos = _parse_expansion(source, pos + 1, variables)
+                out.append(val)
+            else:
+                match = re_plainword.match(source, pos)
+                if not match:
+                    raise ParseException(
+                        'unexpected %r at %d' % (char, pos))
+                out.append(match.group())
+                pos = match.end()
+        variables[name] = ''.join(out)
+        while source[pos:pos+1] in (' ', '\t'):
+            pos += 1
+        char = source[pos:pos+1]
+        if char == '#':
+            end = source.find('\n', pos)
+            pos = size if end < 0 else end + 1
+        elif char == '\n':
+            pos += 1
+        elif char:
+            raise ParseException('trailing garbage at %d' % pos)
     return variables
 
-def uniq(seq):  # Dave Kirby
-    # Order preserving
-    seen = set()
-    return [x for x in seq if x not in seen and not seen.add(x)]
+def uniq(seq):
+    # order preserving: dicts keep insertion order, and fromkeys
+    # dedups in C instead of a per-element set lookup
+    return list(dict.fromkeys(seq))
+
+@functools.lru_cache(maxsize=None)
+def _tmpdir():
+    # one neutral cwd for every bash invocation: the evaluated snippets
+    # never touch the filesystem, so a per-call TemporaryDirectory only
+    # added a mkdtemp/rmtree pair of syscalls per file
+    path = tempfile.mkdtemp(prefix='bashvar-')
+    atexit.register(shutil.rmtree, path, True)
+    return path
 
 def eval_bashvar_ext(source, filename=None):
     # we don't specify encoding here because the env will do.
-    var = []
-    stdin = []
-    for ln in source.splitlines(True):
-        match = re_variable.match(ln)
-        if match:
-            var.append(match.group(1))
-        stdin.append(ln)
-    stdin.append('\n')
-    var = uniq(var)
+    # scan the whole buffer at once instead of matching line by line
+    var = uniq(m.group(1) for m in re_variable.finditer(source))
+    stdin = [source, '\n']
     for v in var:
         # workaround variables containing newlines
         stdin.append('echo "${%s//$\'\\n\'/\\\\n}"\n' % v)
-    with tempfile.TemporaryDirectory() as tmpdir:
-        outs, errs = subprocess.Popen(
-            ('bash', '-r'), cwd=tmpdir, env={},
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE).communicate(''.join(stdin).encode('utf-8'))
+    # stderr stays piped: bash diagnostics feed BashErrorWarning
+    proc = subprocess.run(
+        ('bash', '-r'), cwd=_tmpdir(), env={},
+        input=''.join(stdin).encode('utf-8'),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    outs, errs = proc.stdout, proc.stderr
     if errs:
         warnings.warn(errs.decode('utf-8', 'backslashreplace').rstrip(),
             BashErrorWarning)
     lines = [l.replace('\\n', '\n') for l in outs.decode('utf-8').splitlines()]
     if len(var) != len(lines) and not errs:
         warnings.warn('bash output not expected', BashErrorWarning)
-    return collections.OrderedDict(zip(var, lines))
+    return dict(zip(var, lines))
 
 def eval_bashvar(source, filename=None, msg=False):
     with warnings.catch_warnings(record=True) as wns:
         try:
             ret = eval_bashvar_literal(source)
-        except pp.ParseException:
+        except ParseException:
             ret = eval_bashvar_ext(source)
         msgs = []
         for w in wns:
@@ -230,5 +301,12 @@ def eval_bashvar(source, filename=None, msg=False):
             return ret
 
 def read_bashvar(fp, filename=None, msg=False):
+    if isinstance(fp, bytes):
+        return eval_bashvar(fp.decode('utf-8'), filename, msg)
+    elif isinstance(fp, str):
+        return eval_bashvar(fp, filename, msg)
+    source = fp.read()
+    if isinstance(source, bytes):
+        source = source.decode('utf-8')
     return eval_bashvar(
-        fp.read(), filename or getattr(fp, 'name', None), msg)
+        source, filename or getattr(fp, 'name', None), msg)
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import io
+import os
 import time
 import zlib
 import struct
@@ -286,6 +287,16 @@ class Repo:
         self.db = sqlite3.connect(repository)
         self.db.row_factory = sqlite3.Row
         self.db.execute('PRAGMA case_sensitive_like=1')
+        # we walk the whole history sequentially; serve reads from the
+        # OS page cache instead of one pread() per b-tree page
+        self.db.execute('PRAGMA mmap_size=1073741824')
+        if hasattr(os, 'posix_fadvise') and os.path.isfile(repository):
+            fd = os.open(repository, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
         if check and not NUMPY_AVAILABLE:
             warnings.warn('install numpy to calculate checksum faster')
         self.check = check
@@ -331,6 +342,32 @@ class Repo:
     def file(self, key):
         return self.artifact(key, 'file')
 
+    def files(self, uuids, chunksize=500):
+        '''Get multiple file artifacts as a uuid -> File dict.
+
+        Plain (non-delta) blobs are fetched with one query per chunk;
+        delta-compressed blobs fall back to the recursive lookup in
+        artifact().
+        '''
+        result = {}
+        uuids = list(uuids)
+        for i in range(0, len(uuids), chunksize):
+            chunk = uuids[i:i+chunksize]
+            for rid, uuid, content, isdelta in self.execute(
+                'SELECT rid, uuid, content, '
+                ' EXISTS(SELECT 1 FROM delta WHERE delta.rid=blob.rid) '
+                'FROM blob WHERE uuid IN (%s)' % ','.join('?' * len(chunk)),
+                chunk):
+                if rid in self.cache:
+                    result[uuid] = File(self.cache[rid], rid, uuid)
+                elif not isdelta:
+                    blob = decompress(content)
+                    self.cache[rid] = blob
+                    result[uuid] = File(blob, rid, uuid)
+                else:
+                    result[uuid] = self.file(rid)
+        return result
+
     def manifest(self, key):
         return self.artifact(key, 'structural')
 
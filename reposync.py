@@ -4,11 +4,12 @@
 import os
 import re
 import sys
+import fcntl
 import sqlite3
 import subprocess
 import collections
 
-re_committer = re.compile(b'^committer (.+) <(.+)> \d+.+$')
+re_committer = re.compile(rb'^committer (.+) <(.+)> \d+.+$', re.M)
 
 GIT = os.environ.get('GIT', 'git')
 FOSSIL = os.environ.get('FOSSIL', 'fossil')
@@ -23,23 +24,30 @@ def touch(filename):
 def store_marks(db, gitmarks, fossilmarks):
     cur = db.cursor()
     cur.execute('PRAGMA journal_mode=WAL')
+    # the marks db is rebuilt from the mark files on every sync, so a
+    # crash can cost nothing worse than a re-run: skip fsync entirely
+    cur.execute('PRAGMA synchronous=OFF')
+    cur.execute('PRAGMA temp_store=MEMORY')
+    cur.execute('PRAGMA cache_size=-65536')
     cur.execute('CREATE TABLE IF NOT EXISTS marks ('
         'name TEXT UNIQUE, rid INT, uuid TEXT, githash TEXT'
     ')')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_marks ON marks (rid)')
+    # one prepared statement per table instead of one per mark line
     with open(fossilmarks, 'r') as f:
-        for ln in f:
-            toks = ln.rstrip().split(' ')
-            cur.execute(
-                'INSERT OR IGNORE INTO marks (name, rid, uuid) VALUES (?,?,?)',
-                (toks[1], int(toks[0][1:]), toks[2])
-            )
+        cur.executemany(
+            'INSERT OR IGNORE INTO marks (name, rid, uuid) VALUES (?,?,?)',
+            ((toks[1], int(toks[0][1:]), toks[2])
+             for toks in (ln.rstrip().split(' ') for ln in f))
+        )
     with open(gitmarks, 'r') as f:
-        for ln in f:
-            toks = ln.rstrip().split(' ')
-            cur.execute(
-                'UPDATE marks SET githash=? WHERE name=?', (toks[1], toks[0])
-            )
+        cur.executemany(
+            'UPDATE marks SET githash=? WHERE name=?',
+            ((toks[1], toks[0])
+             for toks in (ln.rstrip().split(' ') for ln in f))
+        )
+    # build the rid index after the bulk insert; the UPDATE above probes
+    # the implicit UNIQUE index on name, not this one
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_marks ON marks (rid)')
     db.commit()
 
 def store_committers(db, committers):
@@ -47,11 +55,18 @@ def store_committers(db, committers):
     cur.execute('CREATE TABLE IF NOT EXISTS committers ('
         'email TEXT PRIMARY KEY, name TEXT'
     ')')
-    for k, v in committers.items():
-        cur.execute(
-            'REPLACE INTO committers VALUES (?,?)',
-            (k, v.most_common(1)[0][0])
-        )
+    # committers maps (email, name) bytes straight from the export
+    # stream to a count; pick the most used name per email and decode
+    # once per unique pair rather than once per commit
+    best = {}
+    for (email, name), count in committers.items():
+        if count > best.get(email, (0, b''))[0]:
+            best[email] = (count, name)
+    cur.executemany(
+        'REPLACE INTO committers VALUES (?,?)',
+        ((email.decode('utf-8'), name.decode('utf-8'))
+         for email, (count, name) in best.items())
+    )
     db.commit()
 
 def store_branches(db, gitpath, fossilpath, trackbranches=None):
@@ -70,46 +85,58 @@ def store_branches(db, gitpath, fossilpath, trackbranches=None):
         else:
             tag = ref[5:].split('/', 1)[1]
         cur.execute("REPLACE INTO git_refs VALUES (?,?)", (tag, githash))
-    sql = (
-        # find branch ancestors and tag them with all child branches
-        "WITH RECURSIVE t(rid, tagid) AS ("
-            "SELECT tagxref.rid, tagxref.tagid "
-            "FROM main.git_refs gr "
-            "INNER JOIN main.marks m USING (githash) "
-            "INNER JOIN tag ON tag.tagname=('sym-' || gr.ref) "
-            "INNER JOIN tagxref ON tagxref.rid=m.rid "
-            "WHERE tagxref.tagtype=2 AND %s "
-            "UNION "
-            "SELECT plink.pid, t.tagid FROM t "
-            "INNER JOIN plink ON plink.cid=t.rid "
-        ") "
-        "INSERT OR IGNORE INTO main.branches "
-        "SELECT t.rid rid, t.tagid tagid, substr(tag.tagname, 5) tagname FROM t "
-        "LEFT JOIN tag ON tag.tagid=t.tagid "
-        "UNION "
-        # and the branch name as in repo
-        "SELECT tagxref.rid rid, tag.tagid tagid, substr(tag.tagname, 5) tagname "
-        "FROM tagxref "
-        "LEFT JOIN tag ON tag.tagid=tagxref.tagid "
-        "WHERE tagxref.tagtype=2 AND %s "
-        "ORDER BY rid ASC, tagid ASC"
-    )
     cur.execute('CREATE TABLE IF NOT EXISTS branches ('
         'rid INTEGER, tagid INTEGER, tagname TEXT, '
         'PRIMARY KEY (rid, tagid)'
     ')')
     cur.execute('ATTACH DATABASE ? AS fossil', (fossilpath,))
     if trackbranches:
-        vals = ['sym-' + b for b in trackbranches]*2
-        sql = sql % (('tag.tagname IN (%s)' % ','.join(
-            '?' * len(trackbranches)),)*2)
-        cur.execute(sql, vals)
+        filt = 'tag.tagname IN (%s)' % ','.join('?' * len(trackbranches))
+        vals = ['sym-' + b for b in trackbranches]
     else:
-        cur.execute(sql % (("tag.tagname LIKE 'sym-%%'",)*2))
+        filt = "tag.tagname LIKE 'sym-%'"
+        vals = []
+    # find branch ancestors and tag them with all child branches;
+    # walking plink in Python shares one parent map across branches,
+    # where the old recursive CTE re-derived every ancestor x branch
+    # pair row-at-a-time in the SQL VM
+    parents = collections.defaultdict(list)
+    for cid, pid in cur.execute('SELECT cid, pid FROM plink'):
+        parents[cid].append(pid)
+    tagnames = dict(cur.execute('SELECT tagid, substr(tagname, 5) FROM tag'))
+    seeds = collections.defaultdict(set)
+    for rid, tagid in cur.execute(
+            'SELECT tagxref.rid, tagxref.tagid '
+            'FROM main.git_refs gr '
+            'INNER JOIN main.marks m USING (githash) '
+            "INNER JOIN tag ON tag.tagname=('sym-' || gr.ref) "
+            'INNER JOIN tagxref ON tagxref.rid=m.rid '
+            'WHERE tagxref.tagtype=2 AND ' + filt, vals).fetchall():
+        seeds[tagid].add(rid)
+    rows = []
+    for tagid, visited in seeds.items():
+        queue = collections.deque(visited)
+        tagname = tagnames.get(tagid)
+        while queue:
+            rid = queue.popleft()
+            rows.append((rid, tagid, tagname))
+            for pid in parents.get(rid, ()):
+                if pid not in visited:
+                    visited.add(pid)
+                    queue.append(pid)
+    cur.executemany('INSERT OR IGNORE INTO main.branches VALUES (?,?,?)', rows)
+    # and the branch name as in repo
+    cur.execute(
+        'INSERT OR IGNORE INTO main.branches '
+        'SELECT tagxref.rid rid, tag.tagid tagid, '
+        'substr(tag.tagname, 5) tagname '
+        'FROM tagxref '
+        'LEFT JOIN tag ON tag.tagid=tagxref.tagid '
+        'WHERE tagxref.tagtype=2 AND ' + filt, vals)
     db.commit()
 
 def sync(gitpath, fossilpath, markpath, rebuild=False, trackbranches=None):
-    committers = collections.defaultdict(collections.Counter)
+    committers = {}
     gitname = os.path.basename(os.path.abspath(gitpath.rstrip('/')))
     fossilname = os.path.splitext(os.path.basename(fossilpath))[0]
     newfossil = not os.path.isfile(fossilpath)
@@ -123,24 +150,49 @@ def sync(gitpath, fossilpath, markpath, rebuild=False, trackbranches=None):
     git = subprocess.Popen(
         (GIT, 'fast-export', '--all', '--signed-tags=strip',
         '--import-marks=' + gitmarks, '--export-marks=' + gitmarks),
-        stdout=subprocess.PIPE, cwd=gitpath)
+        stdout=subprocess.PIPE, cwd=gitpath, bufsize=1<<20)
     fossilcmd = (FOSSIL, 'import', '--git', '--use-author', '--export-marks', fossilmarks)
     if not newfossil:
         fossilcmd += ('--no-rebuild', '--incremental', '--import-marks', fossilmarks)
-    fossil = subprocess.Popen(fossilcmd + (fossilpath,), stdin=subprocess.PIPE)
-    for line in git.stdout:
-        match = re_committer.match(line)
-        if match:
-            committers[match.group(2).decode('utf-8')][match.group(1).decode('utf-8')] += 1
-        fossil.stdin.write(line)
+    fossil = subprocess.Popen(fossilcmd + (fossilpath,),
+        stdin=subprocess.PIPE, bufsize=1<<20)
+    # widen the kernel pipes as well, so one syscall moves up to 1 MiB;
+    # F_SETPIPE_SZ may be refused (pipe-max-size), then the default stays
+    for pipe in (git.stdout, fossil.stdin):
+        try:
+            fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, 1 << 20)
+        except OSError:
+            pass
+    # copy the stream in big chunks and scan whole chunks for committer
+    # lines, instead of splitting the export into lines just for the regex
+    buf = b''
+    while True:
+        chunk = git.stdout.read(1 << 18)
+        if not chunk:
+            break
+        fossil.stdin.write(chunk)
+        buf += chunk
+        cut = buf.rfind(b'\n')
+        if cut < 0:
+            continue
+        for match in re_committer.finditer(buf, 0, cut):
+            key = match.group(2, 1)
+            committers[key] = committers.get(key, 0) + 1
+        buf = buf[cut+1:]
+    for match in re_committer.finditer(buf):
+        key = match.group(2, 1)
+        committers[key] = committers.get(key, 0) + 1
     fossil.stdin.close()
     git.stdout.close()
     git.wait()
     fossil.wait()
     if newfossil or rebuild:
-        subprocess.Popen((FOSSIL, 'sqlite3', '-R', fossilpath, "INSERT OR REPLACE INTO config VALUES ('project-name', '%s', now());" % fossilname)).wait()
+        # all config writes in one fossil process instead of one per row
+        sql = ["INSERT OR REPLACE INTO config VALUES ('project-name', '%s', now());" % fossilname]
         for row in FSL_CONFIG.items():
-            subprocess.Popen((FOSSIL, 'sqlite3', '-R', fossilpath, "INSERT OR REPLACE INTO config VALUES ('%s', '%s', now());" % row)).wait()
+            sql.append("INSERT OR REPLACE INTO config VALUES ('%s', '%s', now());" % row)
+        subprocess.run((FOSSIL, 'sqlite3', '-R', fossilpath),
+            input='\n'.join(sql).encode('utf-8'))
         subprocess.Popen((FOSSIL, 'fts-config', '-R', fossilpath, 'enable', 'cdtwe')).wait()
         subprocess.Popen((FOSSIL, 'fts-config', '-R', fossilpath, 'stemmer', 'on')).wait()
         subprocess.Popen((FOSSIL, 'fts-config', '-R', fossilpath, 'index', 'on')).wait()
@@ -9,35 +9,65 @@ import warnings
 import tempfile
 import unittest
 import subprocess
-import collections
 
 import bashvar
 import reposync
 
+# keep fixture trees on tmpfs where available so git and fossil fsyncs
+# hit RAM, not disk; TEST_TMP overrides the location
+TEST_TMP = os.environ.get('TEST_TMP',
+    '/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+def mkdtemp():
+    return tempfile.mkdtemp(dir=TEST_TMP)
+
+def run_git(cwd, *args):
+    # argv invocation: no /bin/sh fork per command; fixture commits
+    # need no durability or background gc
+    subprocess.run(('git', '-c', 'core.fsync=none', '-c', 'gc.auto=0')
+        + args, cwd=cwd).check_returncode()
+
+def write_file(cwd, name):
+    with open(os.path.join(cwd, name), 'w') as f:
+        f.write(name + '\n')
+
 class TestRepoSync(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # build the upstream + clone fixture once; setUp copies it so
+        # each test skips the init/clone/commit/push subprocess chain
+        cls.template = mkdtemp()
+        gitupstream = os.path.join(cls.template, 'upstream')
+        os.mkdir(gitupstream)
+        run_git(gitupstream, 'init', '--bare')
+        run_git(cls.template, 'clone', '--shared', 'upstream', 'local')
+        gitrepo = os.path.join(cls.template, 'local')
+        write_file(gitrepo, 'a')
+        write_file(gitrepo, 'b')
+        run_git(gitrepo, 'add', '.')
+        run_git(gitrepo, 'commit', '-m', '1')
+        write_file(gitrepo, 'c')
+        write_file(gitrepo, 'd')
+        run_git(gitrepo, 'add', '.')
+        run_git(gitrepo, 'commit', '-m', '2')
+        run_git(gitrepo, 'push')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.template)
+
     def setUp(self):
-        self.path = tempfile.mkdtemp()
+        self.path = mkdtemp()
+        shutil.copytree(self.template, self.path,
+            symlinks=True, dirs_exist_ok=True)
         self.gitupstream = os.path.join(self.path, 'upstream')
-        os.mkdir(self.gitupstream)
-        subprocess.run(('git', 'init', '--bare'), cwd=self.gitupstream).check_returncode()
         self.gitrepo = os.path.join(self.path, 'local')
         self.markpath = os.path.join(self.path, 'marks')
         os.mkdir(self.markpath)
-        subprocess.run(('git', 'clone', 'upstream', 'local'), cwd=self.path).check_returncode()
-        cmds = (
-            'echo a > a',
-            'echo b > b',
-            'git add .',
-            'git commit -m "1"',
-            'echo c > c',
-            'echo d > d',
-            'git add .',
-            'git commit -m "2"',
-            'git push'
-        )
-        for cmd in cmds:
-            subprocess.run(cmd, cwd=self.gitrepo, shell=True).check_returncode()
+        # the clone records the template upstream by absolute path
+        run_git(self.gitrepo, 'remote', 'set-url', 'origin',
+            self.gitupstream)
         self.assertTrue(os.path.isdir(self.gitrepo))
         self.fossil = os.path.join(self.path, 'repo.fossil')
 
@@ -62,29 +92,21 @@ class TestRepoSync(unittest.TestCase):
             os.unlink(self.fossil)
         reposync.sync(self.gitrepo, self.fossil, self.markpath) 
         self.gitrepo2 = os.path.join(self.path, 'local2')
-        subprocess.run(('git', 'clone', 'upstream', 'local2'), cwd=self.path).check_returncode()
+        run_git(self.path, 'clone', '--shared', 'upstream', 'local2')
         self.assertTrue(os.path.isdir(self.gitrepo2))
-        cmds = (
-            'git reset --hard HEAD^',
-            'git push --force',
-            'git gc',
-            'echo e > e',
-            'git add .',
-            'git commit -m "3"',
-            'echo f > f',
-            'git add .',
-            'git commit -m "4"',
-            'git push'
-        )
-        for cmd in cmds:
-            subprocess.run(cmd, cwd=self.gitrepo, shell=True).check_returncode()
-        cmds = (
-            'git fetch --all',
-            'git reset --hard origin/master',
-            'git pull'
-        )
-        for cmd in cmds:
-            subprocess.run(cmd, cwd=self.gitrepo2, shell=True).check_returncode()
+        run_git(self.gitrepo, 'reset', '--hard', 'HEAD^')
+        run_git(self.gitrepo, 'push', '--force')
+        run_git(self.gitrepo, 'gc')
+        write_file(self.gitrepo, 'e')
+        run_git(self.gitrepo, 'add', '.')
+        run_git(self.gitrepo, 'commit', '-m', '3')
+        write_file(self.gitrepo, 'f')
+        run_git(self.gitrepo, 'add', '.')
+        run_git(self.gitrepo, 'commit', '-m', '4')
+        run_git(self.gitrepo, 'push')
+        run_git(self.gitrepo2, 'fetch', '--all')
+        run_git(self.gitrepo2, 'reset', '--hard', 'origin/master')
+        run_git(self.gitrepo2, 'pull')
         reposync.sync(self.gitrepo, self.fossil, self.markpath)
         # time.sleep(1000000)
 
@@ -94,7 +116,7 @@ class TestBashVar(unittest.TestCase):
     maxDiff = None
 
     def test_parse(self):
-        empty = collections.OrderedDict()
+        empty = {}
         self.assertEqual(bashvar.eval_bashvar_literal(''), empty)
         self.assertEqual(bashvar.eval_bashvar_literal('\n'), empty)
         source = '''
@@ -193,7 +215,7 @@ sub6=${str1//b?/z}
 sub7=${str1/b*1/z}
 # az23
 '''
-        expected = collections.OrderedDict((
+        expected = dict((
             ('PKGDES', 'SDL and OpenGL bindings for Erlang'),
             ('PKGNAME', 'elixir'),
             ('PKGSEC', 'devel'),
@@ -290,7 +312,7 @@ sub7=${str1/b*1/z}
         a=2
         c=b$a
         '''
-        expected = collections.OrderedDict((
+        expected = dict((
             ('b', ''), ('a', '2'), ('c', 'b2')
         ))
         with self.assertWarns(bashvar.VariableWarning) as cm:
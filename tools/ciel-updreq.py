@@ -10,8 +10,6 @@ import re
 import sys
 import logging
 import argparse
-import requests
-import readline
 import subprocess
 
 logging.basicConfig(
@@ -19,6 +17,23 @@ logging.basicConfig(
 
 re_variable = re.compile('^\\s*([a-zA-Z_][a-zA-Z0-9_]*)=(.+)$')
 
+session = None
+
+def get_session():
+    # requests drags in a heavy import chain that the --build-only path
+    # never needs, so load it on first use. One session: keep-alive
+    # spares a TLS handshake per API call, and a few retries paper over
+    # transient API hiccups
+    global session
+    if session is None:
+        import requests
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=4,
+            max_retries=requests.adapters.Retry(
+                total=3, backoff_factor=0.3)))
+    return session
+
 ANSI_BOLD = '\x1b[1m'
 ANSI_RESET = '\x1b[0m'
 SUDO = ('sudo',) if os.geteuid() != 0 else ()
@@ -50,18 +65,22 @@ def ask(s, default=None, yn=False):
             return res
 
 def find_package(tree, package):
-    for pkgcate in os.listdir(tree):
-        pkgcate_path = os.path.join(tree, pkgcate)
-        if not os.path.isdir(pkgcate_path):
-            continue
-        for pkgname in os.listdir(pkgcate_path):
-            if pkgname == package:
-                return os.path.join(pkgcate, pkgname)
+    # scandir gets d_type from getdents, so no stat per category, and
+    # one isdir probe per category beats listing its whole contents
+    with os.scandir(tree) as it:
+        for pkgcate in it:
+            if not pkgcate.is_dir(follow_symlinks=False):
+                continue
+            if os.path.isdir(os.path.join(pkgcate.path, package)):
+                return os.path.join(pkgcate.name, package)
 
 def specparse(spec):
     var = {}
     lines = spec.splitlines(True)
     for k, ln in enumerate(lines):
+        # comments and blank lines never match; skip the regex for them
+        if '=' not in ln:
+            continue
         match = re_variable.match(ln)
         if match:
             var[match.group(1)] = (k, match.group(2))
@@ -77,7 +96,8 @@ def specupdate(var, lines, version):
     return ''.join(lines)
 
 def find_upstream(package):
-    req = requests.get('https://packages.aosc.io/packages/%s?type=json' % package)
+    sess = get_session()
+    req = sess.get('https://packages.aosc.io/packages/%s?type=json' % package)
     req.raise_for_status()
     d = req.json()
     srcurl = d['pkg'].get('srcurl_base')
@@ -86,7 +106,7 @@ def find_upstream(package):
     ver = None
     if srcurl.startswith('https://github.com'):
         repo = '/'.join(srcurl.split('/')[3:5])
-        req = requests.get(
+        req = sess.get(
             'https://api.github.com/repos/%s/releases/latest' % repo)
         req.raise_for_status()
         ghrel = req.json()
@@ -100,6 +120,11 @@ def try_build(instance, package):
         SUDO + ('ciel', 'build', '-i', instance, package)).check_returncode()
 
 def interactive(instance, package, build_only=False):
+    try:
+        # line editing and history for ask(); optional
+        import readline
+    except ImportError:
+        pass
     path = find_package('TREE', package)
     if not path:
         raise ValueError("Error: package '%s' not found" % package)
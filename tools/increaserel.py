@@ -14,6 +14,9 @@ def increaserel(spec):
     var = {}
     lines = spec.splitlines(True)
     for k, ln in enumerate(lines):
+        # comments and blank lines never match; skip the regex for them
+        if '=' not in ln:
+            continue
         match = re_variable.match(ln)
         if match:
             var[match.group(1)] = (k, match.group(2))